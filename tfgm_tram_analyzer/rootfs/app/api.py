@@ -12,18 +12,21 @@ Endpoints:
   GET  /health   — health check
 """
 
-import threading
-import time
+import asyncio
+import logging
 import os
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime
-import requests
-from fastapi import FastAPI, BackgroundTasks
+import httpx
+import orjson
+from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 import uvicorn
 
-from tram_analyzer import fetch_and_build
+from tram_analyzer import close_client, describe_error, fetch_and_build, setup_logging
 
-app = FastAPI(title="TfGM Tram Analyzer", version="3.1")
+log = logging.getLogger("tram_analyzer.api")
 
 # ── Configuration ─────────────────────────────────────────────────────────────
 SUPERVISOR_TOKEN = os.getenv("SUPERVISOR_TOKEN", "")
@@ -38,17 +41,35 @@ QUIET_HOURS_END = int(os.getenv("QUIET_HOURS_END", "7"))
 # Logging configuration
 LOG_ONLY_ON_CHANGE = os.getenv("LOG_ONLY_ON_CHANGE", "true").lower() == "true"
 
-# ── Shared state (thread-safe) ────────────────────────────────────────────────
-_state = {
-    "state": "idle",
-    "last_run": None,
-    "last_success": None,
-    "last_error": None,
-    "consecutive_failures": 0,
-    "last_sensor_status": None,  # Track previous status (success/no_service/error) for change detection
-    "in_quiet_hours": False,
-}
-_state_lock = threading.Lock()
+
+# ── Shared state (single writer) ──────────────────────────────────────────────
+# Every writer runs on the event loop, and each update publishes a new frozen
+# snapshot with a single reference assignment. Readers such as /status just
+# read _state; they need no lock and never see a half-applied update.
+@dataclass(frozen=True, slots=True)
+class AnalyzerState:
+    state: str = "idle"
+    last_run: str | None = None
+    last_success: str | None = None
+    last_error: str | None = None
+    consecutive_failures: int = 0
+    last_sensor_status: str | None = None  # Track previous status (success/no_service/error) for change detection
+    in_quiet_hours: bool = False
+
+
+_state = AnalyzerState()
+
+
+def _update_state(**changes) -> None:
+    """Publish a new state snapshot with the given fields changed."""
+    global _state
+    _state = replace(_state, **changes)
+
+
+# The single in-flight analysis, shared by the scheduler and /trigger so a
+# burst of triggers coalesces into one scrape instead of queueing tasks.
+# Also keeps the strong reference the event loop does not hold for us.
+_analysis_task: asyncio.Task | None = None
 
 
 def _is_quiet_hours() -> bool:
@@ -66,29 +87,32 @@ def _is_quiet_hours() -> bool:
 
 
 # ── Supervisor API ────────────────────────────────────────────────────────────
-def _push_sensor(entity_id: str, state: str, attributes: dict) -> None:
-    if not SUPERVISOR_TOKEN:
-        print(f"[WARN] No SUPERVISOR_TOKEN — skipping push for {entity_id}")
-        return
-    url = f"{HA_API}/states/{entity_id}"
-    headers = {
+_SUPERVISOR = httpx.AsyncClient(
+    base_url=HA_API,
+    headers={
         "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
         "Content-Type": "application/json",
-    }
+    },
+    timeout=10,
+)
+
+
+async def _push_sensor(entity_id: str, state: str, attributes: dict) -> None:
+    if not SUPERVISOR_TOKEN:
+        log.warning(f"No SUPERVISOR_TOKEN — skipping push for {entity_id}")
+        return
     try:
-        resp = requests.post(
-            url,
-            headers=headers,
-            json={"state": state, "attributes": attributes},
-            timeout=10,
+        resp = await _SUPERVISOR.post(
+            f"/states/{entity_id}",
+            content=orjson.dumps({"state": state, "attributes": attributes}),
         )
         resp.raise_for_status()
-        print(f"[INFO] Pushed {entity_id} → {state!r}")
+        log.info(f"Pushed {entity_id} → {state!r}")
     except Exception as e:
-        print(f"[WARN] Push failed for {entity_id}: {e}")
+        log.warning(f"Push failed for {entity_id}: {e}")
 
 
-def _push_tram_sensor(result: dict, force: bool = False) -> None:
+async def _push_tram_sensor(result: dict, force: bool = False) -> None:
     status = result.get("status")
     if status == "success":
         state = result["next_tram"]["departure_text"]
@@ -99,17 +123,15 @@ def _push_tram_sensor(result: dict, force: bool = False) -> None:
 
     # Check if STATUS has changed (for log_only_on_change mode)
     # We track status (success/no_service/error), not departure times
-    with _state_lock:
-        last_status = _state.get("last_sensor_status")
-        status_changed = last_status != status
+    status_changed = _state.last_sensor_status != status
 
-        if LOG_ONLY_ON_CHANGE and not force and not status_changed:
-            print(f"[INFO] Status unchanged ({status}) — skipping HA push (state: {state})")
-            return
+    if LOG_ONLY_ON_CHANGE and not force and not status_changed:
+        log.info(f"Status unchanged ({status}) — skipping HA push (state: {state})")
+        return
 
-        _state["last_sensor_status"] = status
+    _update_state(last_sensor_status=status)
 
-    _push_sensor(
+    await _push_sensor(
         "sensor.tram_next_departure",
         state,
         {
@@ -125,132 +147,156 @@ def _push_tram_sensor(result: dict, force: bool = False) -> None:
     )
 
 
-def _push_health_sensor(force: bool = False) -> None:
-    with _state_lock:
-        s = dict(_state)
+async def _push_health_sensor(force: bool = False) -> None:
+    s = _state
 
     # Only push health updates on error or when forced
-    if LOG_ONLY_ON_CHANGE and not force and s["state"] not in ("error", "running"):
+    if LOG_ONLY_ON_CHANGE and not force and s.state not in ("error", "running"):
         return
 
-    _push_sensor(
+    await _push_sensor(
         "sensor.tram_analyzer_health",
-        s["state"],
+        s.state,
         {
-            "last_run": s["last_run"],
-            "last_success": s["last_success"],
-            "last_error": s["last_error"],
-            "consecutive_failures": s["consecutive_failures"],
-            "in_quiet_hours": s.get("in_quiet_hours", False),
+            "last_run": s.last_run,
+            "last_success": s.last_success,
+            "last_error": s.last_error,
+            "consecutive_failures": s.consecutive_failures,
+            "in_quiet_hours": s.in_quiet_hours,
             "friendly_name": "Tram Analyzer Health",
         },
     )
 
 
 # ── Analysis worker ───────────────────────────────────────────────────────────
-def run_analysis() -> None:
-    with _state_lock:
-        if _state["state"] == "running":
-            print("[INFO] Analysis already running — skipping")
-            return
-        _state["state"] = "running"
-        _state["last_run"] = datetime.now().isoformat()
-
-    _push_health_sensor()
+async def run_analysis(start: datetime) -> None:
+    """Scrape once and push to HA; `start` is when _start_analysis() marked
+    the run as running."""
+    await _push_health_sensor()
 
     try:
-        print(f"[INFO] Analysis started at {datetime.now().strftime('%H:%M:%S')}")
-        result = fetch_and_build()
-        result["last_updated"] = datetime.now().isoformat()
+        log.info(f"Analysis started at {start.strftime('%H:%M:%S')}")
+        result = await fetch_and_build()
+        end_iso = datetime.now().isoformat()
+        result["last_updated"] = end_iso
         result["stop_url"] = os.getenv("TRAM_WEBSITE_URL", "")
         result["analyzer_version"] = "3.0"
 
-        with _state_lock:
-            _state["state"] = "success"
-            _state["last_success"] = datetime.now().isoformat()
-            _state["consecutive_failures"] = 0
-            _state["last_error"] = None
+        _update_state(
+            state="success",
+            last_success=end_iso,
+            consecutive_failures=0,
+            last_error=None,
+        )
 
-        _push_tram_sensor(result)
-        _push_health_sensor()
-        print(f"[INFO] Done — status={result.get('status')!r}")
+        await _push_tram_sensor(result)
+        await _push_health_sensor()
+        log.info(f"Done — status={result.get('status')!r}")
 
     except Exception as e:
-        error_msg = str(e)
-        print(f"[ERROR] Analysis failed: {error_msg}")
-
-        with _state_lock:
-            _state["state"] = "error"
-            _state["last_error"] = error_msg
-            _state["consecutive_failures"] += 1
+        error_msg = describe_error(e)
+        end_iso = datetime.now().isoformat()
+        log.error(f"Analysis failed: {error_msg}")
+
+        _update_state(
+            state="error",
+            last_error=error_msg,
+            consecutive_failures=_state.consecutive_failures + 1,
+        )
 
-        _push_sensor(
+        await _push_sensor(
             "sensor.tram_next_departure",
             "Error",
             {
                 "status": "error",
                 "error": error_msg,
-                "last_updated": datetime.now().isoformat(),
+                "last_updated": end_iso,
                 "friendly_name": "Tram Next Departure",
             },
         )
-        _push_health_sensor()
+        await _push_health_sensor()
+
+
+def _start_analysis() -> asyncio.Task:
+    """Return the in-flight analysis task, starting one if none is running."""
+    global _analysis_task
+    if _analysis_task is None or _analysis_task.done():
+        # Mark the run as started before the task is scheduled, so a /trigger
+        # arriving in between already reports this run's started_at.
+        # One clock read, reused for state, payload and log lines.
+        start = datetime.now()
+        _update_state(state="running", last_run=start.isoformat())
+        _analysis_task = asyncio.create_task(run_analysis(start))
+    return _analysis_task
 
 
 # ── Scheduler ─────────────────────────────────────────────────────────────────
-def _scheduler() -> None:
-    print(f"[INFO] Scheduler started — interval={SCAN_INTERVAL}s")
+async def _scheduler() -> None:
+    log.info(f"Scheduler started — interval={SCAN_INTERVAL}s")
     if QUIET_HOURS_ENABLED:
-        print(f"[INFO] Quiet hours enabled: {QUIET_HOURS_START:02d}:00 - {QUIET_HOURS_END:02d}:00")
+        log.info(f"Quiet hours enabled: {QUIET_HOURS_START:02d}:00 - {QUIET_HOURS_END:02d}:00")
     if LOG_ONLY_ON_CHANGE:
-        print("[INFO] Log only on change: enabled")
+        log.info("Log only on change: enabled")
 
     while True:
         if _is_quiet_hours():
-            with _state_lock:
-                was_quiet = _state.get("in_quiet_hours", False)
-                _state["in_quiet_hours"] = True
-                _state["state"] = "quiet"
+            was_quiet = _state.in_quiet_hours
+            _update_state(in_quiet_hours=True, state="quiet")
 
             if not was_quiet:
-                print(f"[INFO] Entering quiet hours ({QUIET_HOURS_START:02d}:00 - {QUIET_HOURS_END:02d}:00) — pausing scrapes")
-                _push_health_sensor(force=True)
+                log.info(f"Entering quiet hours ({QUIET_HOURS_START:02d}:00 - {QUIET_HOURS_END:02d}:00) — pausing scrapes")
+                await _push_health_sensor(force=True)
         else:
-            with _state_lock:
-                was_quiet = _state.get("in_quiet_hours", False)
-                _state["in_quiet_hours"] = False
+            was_quiet = _state.in_quiet_hours
+            _update_state(in_quiet_hours=False)
 
             if was_quiet:
-                print("[INFO] Exiting quiet hours — resuming scrapes")
+                log.info("Exiting quiet hours — resuming scrapes")
+
+            await _start_analysis()
 
-            run_analysis()
+        await asyncio.sleep(SCAN_INTERVAL)
 
-        time.sleep(SCAN_INTERVAL)
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    scheduler = asyncio.create_task(_scheduler())
+    yield
+    # Stop anything still using the HTTP clients before closing them
+    tasks = [scheduler]
+    if _analysis_task is not None:
+        tasks.append(_analysis_task)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await _SUPERVISOR.aclose()
+    await close_client()
+
+
+app = FastAPI(title="TfGM Tram Analyzer", version="3.1", lifespan=_lifespan)
 
 
 # ── Endpoints ─────────────────────────────────────────────────────────────────
 @app.post("/trigger")
-async def trigger(background_tasks: BackgroundTasks):
+async def trigger():
     """Manually trigger a tram data scrape (returns immediately)."""
-    with _state_lock:
-        if _state["state"] == "running":
-            return JSONResponse(
-                status_code=200,
-                content={
-                    "status": "already_running",
-                    "message": "Analysis already in progress",
-                    "started_at": _state["last_run"],
-                },
-            )
-    background_tasks.add_task(run_analysis)
+    if _analysis_task is not None and not _analysis_task.done():
+        return JSONResponse(
+            status_code=200,
+            content={
+                "status": "already_running",
+                "message": "Analysis already in progress",
+                "started_at": _state.last_run,
+            },
+        )
+    _start_analysis()
     return {"status": "triggered", "timestamp": datetime.now().isoformat()}
 
 
 @app.get("/status")
 async def get_status():
     """Current analyzer state."""
-    with _state_lock:
-        return dict(_state)
+    return asdict(_state)
 
 
 @app.get("/health")
@@ -261,6 +307,9 @@ async def health():
 
 # ── Entry point ───────────────────────────────────────────────────────────────
 if __name__ == "__main__":
-    print(f"TfGM Tram Analyzer v3.1 — interval={SCAN_INTERVAL}s")
-    threading.Thread(target=_scheduler, daemon=True).start()
-    uvicorn.run(app, host="0.0.0.0", port=5001, log_level="warning")
+    listener = setup_logging("[%(levelname)s] %(message)s")
+    log.info(f"TfGM Tram Analyzer v3.1 — interval={SCAN_INTERVAL}s")
+    try:
+        uvicorn.run(app, host="0.0.0.0", port=5001, log_level="warning")
+    finally:
+        listener.stop()
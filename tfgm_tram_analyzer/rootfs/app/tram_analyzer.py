@@ -12,16 +12,25 @@ Configuration via environment variables:
 
 import os
 import re
-import json
-import requests
-from bs4 import BeautifulSoup
+import html
+import asyncio
+import logging
+import logging.handlers
+import queue
+import string
+import ahocorasick
+import httpx
+import orjson
 from datetime import datetime
 
+log = logging.getLogger("tram_analyzer")
+
 URL = os.getenv(
     "TRAM_WEBSITE_URL",
     "https://tfgm.com/travel-updates/live-departures/tram/prestwich-tram"
 )
 OUTPUT_FILE = os.getenv("OUTPUT_FILE", "/share/tram_status.json")
+_OUTPUT_DIR = os.path.dirname(os.path.abspath(OUTPUT_FILE))
 DESTINATIONS = [
     d.strip().lower()
     for d in os.getenv("DESTINATIONS", "Piccadilly").split(",")
@@ -37,6 +46,22 @@ HEADERS = {
     "Accept-Language": "en-GB,en;q=0.9",
 }
 
+# Shared async client so successive scrapes reuse the keep-alive HTTP/2
+# connection without tying up a thread while waiting on the network.
+# With the brotli extra installed httpx advertises and decodes br as well
+# as gzip/deflate.
+_HTTPX = httpx.AsyncClient(
+    headers=HEADERS,
+    timeout=15,
+    http2=True,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=2, max_keepalive_connections=1),
+)
+
+# Validators and parsed result of the last 200 response — lets an unchanged
+# page come back as 304 Not Modified and skip parsing entirely
+_CACHED = {"etag": None, "last_modified": None, "departures": None}
+
 # All known Metrolink destinations — anchors the regex to avoid noise
 # These are the main termini and key stops used for filtering
 VALID_DESTINATIONS = {
@@ -54,91 +79,155 @@ VALID_DESTINATIONS = {
     "victoria",
 }
 
+# Cheap HTML → text: drop <head>/script/style bodies, then every remaining tag
+_SCRIPT_RE = re.compile(r"<(head|script|style)\b.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+# Isolates the departures section between "Live Departures" and "Footer"
+_SECTION_RE = re.compile(
+    r"Live Departures.*?Updated.*?ago(.*?)Footer",
+    re.DOTALL | re.IGNORECASE
+)
+
+# Multi-pattern automaton over the known destinations — finds every
+# destination in one linear pass over the lower-cased section text
+_DEST_AUTOMATON = ahocorasick.Automaton()
+for _dest in VALID_DESTINATIONS:
+    _DEST_AUTOMATON.add_word(_dest, _dest)
+_DEST_AUTOMATON.make_automaton()
+
+# ASCII-only lower-casing keeps every offset aligned with the original text
+# (str.lower() can lengthen the string, e.g. "İ" → "i̇"); the destinations
+# are all ASCII, so nothing the automaton needs is left upper-case
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# Applied directly after each destination hit. Anchoring on known destination
+# names avoids noise text like "Upcoming disruptions Victoria Double tram
+# 3 mins" being parsed as destination "Upcoming disruptions Victoria"
+_TRAM_SUFFIX_RE = re.compile(
+    r"\s+(Single|Double)\s+tram\s+"
+    r"([\d]+\s+mins?|Due|Arrived|Departing|Now)",
+    re.IGNORECASE
+)
+
+# Case-insensitive substring match against any configured destination filter,
+# done in one C-level scan per row ("(?!)" never matches if none configured)
+_DEST_MATCH = re.compile(
+    "|".join(re.escape(d) for d in DESTINATIONS) or "(?!)",
+    re.IGNORECASE
+).search
+
+# Departure words meaning the tram is at (or leaving) the platform
+_KEYWORD_MINUTES = {"due": 0, "arrived": 0, "departing": 0, "now": 0}
+
+
+def setup_logging(fmt: str = "%(message)s") -> logging.handlers.QueueListener:
+    """Route log records through a queue so callers never block on stderr.
+
+    Returns the started listener; stop it on shutdown to flush pending records.
+    """
+    q = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(fmt))
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(q))
+    # INFO for this app's loggers only; libraries such as httpx (which logs
+    # every request at INFO) stay at the root's default WARNING level
+    log.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(q, stream)
+    listener.start()
+    return listener
+
 
 def parse_minutes(text: str) -> int:
     """Convert departure text to integer minutes.
     'Due' / 'Arrived' / 'Departing' → 0
     '4 mins' → 4
     """
-    text = text.lower().strip()
-    if any(w in text for w in ["due", "arrived", "departing", "now"]):
-        return 0
-    m = re.search(r"(\d+)", text)
-    return int(m.group(1)) if m else 99
+    # Only the first word matters: a keyword, or the number in "4 mins"
+    words = text.lower().split(None, 1)
+    head = words[0] if words else ""
+    minutes = _KEYWORD_MINUTES.get(head)
+    if minutes is not None:
+        return minutes
+    return int(head) if head.isdecimal() else 99
 
 
-def fetch_departures() -> list[dict]:
+async def fetch_departures() -> list[dict]:
     """Fetch and parse the TfGM live departure board.
 
     Returns list of all departures as dicts:
         destination, carriages, departure_text, minutes_until
-    Sorted ascending by minutes_until.
+    Sorted ascending by minutes_until. A 304 response to the conditional
+    request returns the previously parsed list unchanged.
     """
-    resp = requests.get(URL, headers=HEADERS, timeout=15)
+    headers = {}
+    if _CACHED["departures"] is not None:
+        if _CACHED["etag"]:
+            headers["If-None-Match"] = _CACHED["etag"]
+        if _CACHED["last_modified"]:
+            headers["If-Modified-Since"] = _CACHED["last_modified"]
+
+    resp = await _HTTPX.get(URL, headers=headers)
+    if resp.status_code == 304 and _CACHED["departures"] is not None:
+        return _CACHED["departures"]
     resp.raise_for_status()
 
-    soup = BeautifulSoup(resp.text, "html.parser")
-    body_text = soup.body.get_text(" ", strip=True) if soup.body else resp.text
+    # Strip markup with regex rather than building a DOM — only the text
+    # content is needed for the departure regex below
+    section_html = _SCRIPT_RE.sub(" ", resp.text)
+    body_text = html.unescape(_TAG_RE.sub(" ", section_html))
 
-    # Isolate the departures section between "Live Departures" and "Footer"
-    match = re.search(
-        r"Live Departures.*?Updated.*?ago(.*?)Footer",
-        body_text,
-        re.DOTALL | re.IGNORECASE
-    )
+    match = _SECTION_RE.search(body_text)
     section = match.group(1) if match else body_text
 
-    # Build alternation from known destinations, longest first
-    # to avoid partial matches (e.g. "Manchester Airport" before "Manchester")
-    dest_pattern = "|".join(
-        sorted(VALID_DESTINATIONS, key=len, reverse=True)
-    )
-
-    # Pattern anchors on known destination names — avoids noise text like
-    # "Upcoming disruptions Victoria Double tram 3 mins" being parsed as
-    # destination "Upcoming disruptions Victoria"
-    pattern = re.compile(
-        rf"({dest_pattern})\s+"
-        r"(Single|Double)\s+tram\s+"
-        r"([\d]+\s+mins?|Due|Arrived|Departing|Now)",
-        re.IGNORECASE
-    )
-
     departures = []
     seen = set()
 
-    for m in pattern.finditer(section):
-        dest = m.group(1).strip().title()
-        carriages = m.group(2).strip()
-        wait_text = m.group(3).strip()
-        key = f"{dest.lower()}:{wait_text.lower()}"
+    # iter_long yields the longest non-overlapping hits, so "East Didsbury"
+    # wins over the "bury" it ends with
+    for end_idx, dest_name in _DEST_AUTOMATON.iter_long(section.translate(_ASCII_LOWER)):
+        m = _TRAM_SUFFIX_RE.match(section, end_idx + 1)
+        if not m:
+            continue
+        wait_text = m.group(2).strip()
 
+        # dest_name is already the canonical lower-case destination
+        key = (dest_name, wait_text)
         if key in seen:
             continue
         seen.add(key)
 
         departures.append({
-            "destination": dest,
-            "carriages": carriages,
+            "destination": dest_name.title(),
+            "carriages": m.group(1).strip(),
             "departure_text": wait_text,
             "minutes_until": parse_minutes(wait_text),
         })
 
     departures.sort(key=lambda x: x["minutes_until"])
+
+    _CACHED["etag"] = resp.headers.get("ETag")
+    _CACHED["last_modified"] = resp.headers.get("Last-Modified")
+    _CACHED["departures"] = departures
     return departures
 
 
+def _matches_destination(departure: dict) -> bool:
+    """True if the departure is bound for one of the configured DESTINATIONS."""
+    return _DEST_MATCH(departure["destination"]) is not None
+
+
 def build_result(departures: list[dict]) -> dict:
     """Filter for target destinations and build output JSON."""
-    target = [
-        d for d in departures
-        if any(dest in d["destination"].lower() for dest in DESTINATIONS)
-    ]
+    # Departures are sorted soonest-first, so the first match is the next tram;
+    # the rest of the same generator then yields the remaining matches
+    matches = (d for d in departures if _matches_destination(d))
+    next_t = next(matches, None)
 
     now = datetime.now().isoformat()
     dest_display = " / ".join(d.title() for d in DESTINATIONS)
 
-    if not target:
+    if next_t is None:
         return {
             "status": "no_service",
             "message": f"No {dest_display}-bound trams in current departures",
@@ -147,14 +236,15 @@ def build_result(departures: list[dict]) -> dict:
             "timestamp": now,
         }
 
+    target = [next_t, *matches]
     return {
         "status": "success",
         "destination_filters": DESTINATIONS,
         "next_tram": {
-            "departure_text": target[0]["departure_text"],
-            "minutes_until": target[0]["minutes_until"],
-            "destination": target[0]["destination"],
-            "carriages": target[0]["carriages"],
+            "departure_text": next_t["departure_text"],
+            "minutes_until": next_t["minutes_until"],
+            "destination": next_t["destination"],
+            "carriages": next_t["carriages"],
         },
         "all_destination_trams": [
             {
@@ -170,9 +260,9 @@ def build_result(departures: list[dict]) -> dict:
     }
 
 
-def fetch_and_build() -> dict:
+async def fetch_and_build() -> dict:
     """Fetch departures and build result dict. Does not write to file."""
-    departures = fetch_departures()
+    departures = await fetch_departures()
     if not departures:
         return {
             "status": "error",
@@ -182,8 +272,37 @@ def fetch_and_build() -> dict:
     return build_result(departures)
 
 
+def describe_error(e: Exception) -> str:
+    """One-line error text for HA attributes and the status file.
+
+    httpx status errors span two lines (with a trailing MDN link), and some
+    transport errors such as timeouts stringify to an empty message.
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"HTTP {e.response.status_code} from {e.request.url}"
+    lines = str(e).strip().splitlines()
+    return lines[0] if lines else type(e).__name__
+
+
+async def close_client() -> None:
+    """Close the shared HTTP client (call on service shutdown)."""
+    await _HTTPX.aclose()
+
+
+async def _fetch_once() -> dict:
+    """Single CLI run: fetch, then close the client inside the same loop."""
+    try:
+        return await fetch_and_build()
+    finally:
+        await close_client()
+
+
 def save_result(result: dict) -> dict:
-    """Write result to JSON file for Home Assistant."""
+    """Write result to JSON file for Home Assistant.
+
+    The file is replaced atomically. The output directory must already
+    exist (main() creates it at startup).
+    """
     output = {
         **result,
         "last_updated": datetime.now().isoformat(),
@@ -192,57 +311,68 @@ def save_result(result: dict) -> dict:
         "method": "html_parse",
     }
 
-    os.makedirs(os.path.dirname(os.path.abspath(OUTPUT_FILE)), exist_ok=True)
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump(output, f, indent=2)
+    # Write alongside then rename, so readers never see a half-written file
+    tmp_file = OUTPUT_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, OUTPUT_FILE)
 
-    print(f"💾 Saved → {OUTPUT_FILE}")
+    log.info(f"💾 Saved → {OUTPUT_FILE}")
     return output
 
 
 def main():
     start = datetime.now()
-    print(f"🚋 TfGM Tram Analyzer v3.1 — {start.strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"🔗 Stop: {URL}")
+    log.info(f"🚋 TfGM Tram Analyzer v3.1 — {start.strftime('%Y-%m-%d %H:%M:%S')}")
+    log.info(f"🔗 Stop: {URL}")
     dest_display = " / ".join(d.title() for d in DESTINATIONS)
-    print(f"🎯 Filtering for: {dest_display}\n")
+    log.info(f"🎯 Filtering for: {dest_display}")
+
+    # Created once here rather than on every save_result call
+    os.makedirs(_OUTPUT_DIR, exist_ok=True)
 
     try:
-        result = fetch_and_build()
+        result = asyncio.run(_fetch_once())
 
         if result.get("status") == "error":
-            print(f"⚠️  {result.get('error')}")
+            log.warning(f"⚠️  {result.get('error')}")
         else:
             departures = result.get("all_departures", [])
-            print(f"✅ {len(departures)} departures found:")
+            log.info(f"✅ {len(departures)} departures found:")
             for d in departures:
-                icon = "🚋" if any(dest in d["destination"].lower() for dest in DESTINATIONS) else "  "
-                print(f"  {icon} {d['destination']} ({d['carriages']}) → {d['departure_text']}")
+                icon = "🚋" if _matches_destination(d) else "  "
+                log.info(f"  {icon} {d['destination']} ({d['carriages']}) → {d['departure_text']}")
             target_count = len(result.get("all_destination_trams", []))
-            print(f"\n🎯 {dest_display} trams: {target_count}")
+            log.info(f"🎯 {dest_display} trams: {target_count}")
 
-        output = save_result(result)
+        save_result(result)
         elapsed = (datetime.now() - start).total_seconds()
-        print(f"⚡ {elapsed:.2f}s total")
-        print(f"\n📊 Output:\n{json.dumps(output, indent=2)}")
-
-    except requests.RequestException as e:
-        print(f"❌ Network error: {e}")
+        log.info(
+            f"⚡ {elapsed:.2f}s total — status={result.get('status')!r}, "
+            f"{len(result.get('all_departures', []))} departures"
+        )
+
+    except httpx.HTTPError as e:
+        error_msg = describe_error(e)
+        log.error(f"❌ Network error: {error_msg}")
         save_result({
             "status": "error",
-            "error": f"Network error: {e}",
+            "error": f"Network error: {error_msg}",
             "timestamp": datetime.now().isoformat(),
         })
     except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        error_msg = describe_error(e)
+        log.exception(f"❌ Error: {error_msg}")
         save_result({
             "status": "error",
-            "error": str(e),
+            "error": error_msg,
             "timestamp": datetime.now().isoformat(),
         })
 
 
 if __name__ == "__main__":
-    main()
+    listener = setup_logging()
+    try:
+        main()
+    finally:
+        listener.stop()